@@ -1,19 +1,44 @@
 #! /usr/bin/env python3
 
+import asyncio
+import atexit
+import gc
 import logging
+import os
+import pickle
+import queue
+import signal
 import sys
-import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from signal import pause
 from enum import Enum
+from functools import cached_property, partial
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
-import yaml
 from gpiozero import Button
 
 from audioInterface import AudioInterface
 
-logging.basicConfig(level=logging.INFO)
+class LocalQueueHandler(QueueHandler):
+    """
+    Queue handler for an in-process queue: records are enqueued as they are,
+    leaving message formatting to the listener thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+# Logging calls only enqueue the record, the listener thread formats and
+# writes it so that slow console/journal writes stay off the event loop
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(log_queue, log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[LocalQueueHandler(log_queue)])
 logger = logging.getLogger(__name__)
 
 class CurrentEvent(Enum):
@@ -21,17 +46,64 @@ class CurrentEvent(Enum):
     HOOK = 1
     RECORD_GREETING = 2
 
+@dataclass(frozen=True)
+class Config:
+    """
+    Configuration parameters loaded from the YAML file.
+
+    Building it validates the configuration once at startup: a missing or
+    unknown key fails immediately instead of in the middle of a call.
+    """
+
+    alsa_hw_mapping: str
+    mixer_control_name: str
+    format: str
+    file_type: str
+    channels: int
+    hook_gpio: int
+    hook_type: str
+    hook_bounce_time: Optional[float]
+    recording_limit: int
+    sample_rate: int
+    record_greeting_gpio: int
+    record_greeting_type: str
+    record_greeting_bounce_time: Optional[float]
+    beep: str
+    beep_volume: float
+    beep_start_delay: float
+    beep_include_in_message: bool
+    greeting: str
+    greeting_volume: float
+    greeting_start_delay: float
+    time_exceeded: str
+    time_exceeded_volume: float
+    recordings_path: str
+    time_exceeded_length: float
+    alsa_buffer_time: Optional[int] = None
+    audio_realtime_priority: int = 0
+
 class AudioGuestBook:
     """
     Manages the rotary phone audio guest book application.
 
     This class initializes the application, handles phone hook events, and
     coordinates audio playback and recording based on the phone's hook status.
+    All event handling runs on a single asyncio event loop; blocking audio
+    playback is delegated to the loop's executor.
 
     Attributes:
         config_path (str): Path to the application configuration file.
-        config (dict): Configuration parameters loaded from the YAML file.
+        config (Config): Configuration parameters loaded from the YAML file.
         audio_interface (AudioInterface): Interface for audio playback and recording.
+        recordings_path (str): Directory where guest recordings are saved.
+        greeting_path (str): Path to the greeting sound, also the target of a recorded greeting.
+        beep_path (str): Path to the beep sound.
+        time_exceeded_path (str): Path to the time exceeded sound.
+        loop (asyncio.AbstractEventLoop): Event loop running the application.
+        audio_executor (ThreadPoolExecutor): Long-lived worker threads running blocking audio calls.
+        audio_cpu (int or None): CPU core reserved for the audio processes, None on single core boards.
+        greeting_task (asyncio.Task or None): Greeting/beep sequence of the current event.
+        timer (asyncio.TimerHandle or None): Pending time exceeded event of the current recording.
     """
 
     def __init__(self, config_path):
@@ -41,49 +113,201 @@ class AudioGuestBook:
         Args:
             config_path (str): Path to the configuration YAML file.
         """
+        # Reserve a core before the worker threads are started so that they inherit
+        # the affinity of the main thread
+        self.audio_cpu = self.reserve_audio_cpu()
         self.config_path = config_path
         self.config = self.load_config()
-        self.audio_interface = AudioInterface(
-            alsa_hw_mapping=self.config["alsa_hw_mapping"],
-            format=self.config["format"],
-            file_type=self.config["file_type"],
-            recording_limit=self.config["recording_limit"],
-            sample_rate=self.config["sample_rate"],
-            channels=self.config["channels"],
-            mixer_control_name=self.config["mixer_control_name"],
+        # Resolve the file paths once so the call handlers only join strings
+        self.recordings_path = str(Path(self.config.recordings_path))
+        self.greeting_path = str(Path(self.config.greeting))
+        self.beep_path = str(Path(self.config.beep))
+        self.time_exceeded_path = str(Path(self.config.time_exceeded))
+        self.loop = asyncio.new_event_loop()
+        # A call needs at most the greeting/beep sequence and the time exceeded
+        # message, keep a fixed pair of threads around for them
+        self.audio_executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="audio"
         )
+        self.loop.set_default_executor(self.audio_executor)
         self.setup_hook()
         self.setup_record_greeting()
         self.current_event = CurrentEvent.NONE
+        self.pending_recording = None
+        self.greeting_task = None
+        self.timer = None
+
+    @cached_property
+    def audio_interface(self):
+        """
+        Interface for audio playback and recording, created on first use so
+        that startup is not delayed by it.
+        """
+        return AudioInterface(
+            alsa_hw_mapping=self.config.alsa_hw_mapping,
+            format=self.config.format,
+            file_type=self.config.file_type,
+            recording_limit=self.config.recording_limit,
+            sample_rate=self.config.sample_rate,
+            channels=self.config.channels,
+            mixer_control_name=self.config.mixer_control_name,
+            buffer_time=self.config.alsa_buffer_time,
+            realtime_priority=self.config.audio_realtime_priority,
+            audio_cpu=self.audio_cpu,
+        )
+
+    @cached_property
+    def play_greeting(self):
+        """
+        Plays the greeting sound, bound once to its path, volume and delay.
+        """
+        return partial(
+            self.audio_interface.play_audio,
+            self.greeting_path,
+            self.config.greeting_volume,
+            self.config.greeting_start_delay,
+        )
+
+    @cached_property
+    def play_beep(self):
+        """
+        Plays the beep sound, bound once to its path, volume and delay.
+        """
+        return partial(
+            self.audio_interface.play_audio,
+            self.beep_path,
+            self.config.beep_volume,
+            self.config.beep_start_delay,
+        )
+
+    @cached_property
+    def play_time_exceeded(self):
+        """
+        Plays the time exceeded sound, bound once to its path and volume.
+        """
+        return partial(
+            self.audio_interface.play_audio,
+            self.time_exceeded_path,
+            self.config.time_exceeded_volume,
+            0,
+        )
+
+    def reserve_audio_cpu(self):
+        """
+        Reserves the last CPU core for the audio processes by restricting the
+        application itself to the remaining cores.
+
+        Returns:
+            int or None: The reserved core, or None if there is only one core
+            (e.g. Pi Zero) or the affinity cannot be changed.
+        """
+        try:
+            cpus = os.sched_getaffinity(0)
+            if len(cpus) < 2:
+                return None
+            audio_cpu = max(cpus)
+            os.sched_setaffinity(0, cpus - {audio_cpu})
+        except OSError as e:
+            logger.warning("Could not reserve a CPU core for audio: %s", e)
+            return None
+        return audio_cpu
 
     def load_config(self):
         """
-        Loads the application configuration from a YAML file.
+        Loads and validates the application configuration.
+
+        Exits the application if the configuration file is missing or has
+        missing or unknown keys.
+        """
+        try:
+            return Config(**self.read_config())
+        except TypeError:
+            # The cache may be damaged, retry straight from the YAML file
+            pass
+        try:
+            return Config(**self.read_config(use_cache=False))
+        except TypeError as e:
+            logger.error("Invalid configuration file %s: %s", self.config_path, e)
+            sys.exit(1)
+
+    def read_config(self, use_cache=True):
+        """
+        Reads the raw configuration dictionary from the YAML file.
+
+        The parsed configuration is cached in a pickle sidecar next to the
+        YAML file and reused as long as it is newer than the YAML file.
+
+        Args:
+            use_cache (bool, optional): Whether the sidecar cache may be used. Defaults to True.
 
         Raises:
             FileNotFoundError: If the configuration file does not exist.
         """
         try:
-            with open(self.config_path, "r") as f:
-                return yaml.safe_load(f)
+            config_mtime = os.stat(self.config_path).st_mtime
         except FileNotFoundError as e:
-            logger.error(f"Configuration file not found: {e}")
+            logger.error("Configuration file not found: %s", e)
             sys.exit(1)
 
+        # Reuse the parsed config from the sidecar cache if it is up to date
+        cache_path = f"{self.config_path}.pkl"
+        try:
+            if use_cache and os.stat(cache_path).st_mtime >= config_mtime:
+                with open(cache_path, "rb") as f:
+                    config = pickle.load(f)
+                if isinstance(config, dict):
+                    return config
+                logger.warning("Config cache %s is invalid, parsing YAML.", cache_path)
+        except Exception as e:
+            # A corrupt cache must never keep the application from starting
+            logger.debug("Config cache unavailable, parsing YAML: %s", e)
+
+        # Only import yaml when the cache cannot be used, it is slow to import
+        import yaml
+
+        try:
+            # libyaml-backed loader, several times faster than the pure-Python one
+            from yaml import CSafeLoader as YamlLoader
+        except ImportError:
+            from yaml import SafeLoader as YamlLoader
+
+        with open(self.config_path, "r") as f:
+            config = yaml.load(f, Loader=YamlLoader)
+
+        # Write to a temporary file first so that a power cut cannot leave a
+        # truncated cache behind that looks up to date
+        tmp_path = f"{cache_path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(config, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning("Could not write config cache %s: %s", cache_path, e)
+        return config
+
     def setup_hook(self):
         """
         Sets up the phone hook switch with GPIO based on the configuration.
         """
-        hook_gpio = self.config["hook_gpio"]
-        pull_up = self.config["hook_type"] == "NC"
-        bounce_time = self.config["hook_bounce_time"]
+        hook_gpio = self.config.hook_gpio
+        pull_up = self.config.hook_type == "NC"
+        bounce_time = self.config.hook_bounce_time
         self.hook = Button(hook_gpio, pull_up=pull_up, bounce_time=bounce_time)
         if pull_up:
-            self.hook.when_pressed = self.off_hook
-            self.hook.when_released = self.on_hook
+            self.hook.when_pressed = self.threadsafe(self.off_hook)
+            self.hook.when_released = self.threadsafe(self.on_hook)
         else:
-            self.hook.when_pressed = self.on_hook
-            self.hook.when_released = self.off_hook
+            self.hook.when_pressed = self.threadsafe(self.on_hook)
+            self.hook.when_released = self.threadsafe(self.off_hook)
+
+    def threadsafe(self, callback):
+        """
+        Wraps a GPIO callback so that it runs on the event loop instead of
+        the gpiozero thread that detected the edge.
+        """
+        return lambda: self.loop.call_soon_threadsafe(callback)
 
     def off_hook(self):
         """
@@ -97,9 +321,10 @@ class AudioGuestBook:
         logger.info("Phone off hook, ready to begin!")
 
         self.current_event = CurrentEvent.HOOK # Ensure playback can continue
-        # Start the greeting playback in a separate thread
-        self.greeting_thread = threading.Thread(target=self.play_greeting_and_beep)
-        self.greeting_thread.start()
+        gc.disable() # No collection pauses during the call
+        # Start the greeting playback as a task on the event loop
+        self.greeting_task = asyncio.create_task(self.play_greeting_and_beep())
+        self.greeting_task.add_done_callback(self.log_failure)
 
     def start_recording(self, output_file: str):
         """
@@ -108,47 +333,67 @@ class AudioGuestBook:
         self.audio_interface.start_recording(output_file)
         logger.info("Recording started...")
 
-        # Start a timer to handle the time exceeded event
-        self.timer = threading.Timer(
-            self.config["time_exceeded_length"], self.time_exceeded
+        # Schedule the time exceeded event
+        self.timer = self.loop.call_later(
+            self.config.time_exceeded_length, self.schedule_time_exceeded
         )
-        self.timer.start()
 
-    def play_greeting_and_beep(self):
+    def schedule_time_exceeded(self):
+        """
+        Runs the time exceeded event in the executor, as it blocks on playback.
+        """
+        future = self.loop.run_in_executor(None, self.time_exceeded)
+        future.add_done_callback(self.log_failure)
+
+    def log_failure(self, future):
+        """
+        Logs the exception of a failed task or executor future, which would
+        otherwise be dropped silently.
+        """
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if exception is not None:
+            logger.error("Error during audio event", exc_info=exception)
+
+    def is_current(self, event):
+        """
+        Checks that `event` is still in progress and that the calling greeting
+        sequence belongs to it rather than to an earlier, cancelled one.
+        """
+        return self.current_event == event and asyncio.current_task() is self.greeting_task
+
+    async def play_greeting_and_beep(self):
         """
         Plays the greeting and beep sounds, checking for the on-hook event.
         """
         # Play the greeting
-        self.audio_interface.continue_playback = self.current_event == CurrentEvent.HOOK
+        if self.is_current(CurrentEvent.HOOK):
+            self.audio_interface.allow_playback()
         logger.info("Playing voicemail...")
-        self.audio_interface.play_audio(
-            self.config["greeting"],
-            self.config["greeting_volume"],
-            self.config["greeting_start_delay"],
-        )
+        await self.loop.run_in_executor(None, self.play_greeting)
 
-        output_file = str(
-            Path(self.config["recordings_path"]) / f"{datetime.now().isoformat()}.wav"
-        )
-        include_beep = bool(self.config["beep_include_in_message"])
+        # Record under the raw wall clock in nanoseconds, the recording gets its
+        # ISO timestamp name once the call has ended (see name_recording)
+        started_at = time.time_ns()
+        output_file = os.path.join(self.recordings_path, f"{started_at}.wav")
+        include_beep = bool(self.config.beep_include_in_message)
 
         # Check if the phone is still off-hook
         # Start recording already BEFORE the beep (beep will be included in message)
-        if self.current_event == CurrentEvent.HOOK and include_beep:
+        if self.is_current(CurrentEvent.HOOK) and include_beep:
+            self.pending_recording = (output_file, started_at)
             self.start_recording(output_file)
 
         # Play the beep
-        if self.current_event == CurrentEvent.HOOK:
+        if self.is_current(CurrentEvent.HOOK):
             logger.info("Playing beep...")
-            self.audio_interface.play_audio(
-                self.config["beep"],
-                self.config["beep_volume"],
-                self.config["beep_start_delay"],
-            )
+            await self.loop.run_in_executor(None, self.play_beep)
 
         # Check if the phone is still off-hook
         # Start recording AFTER the beep (beep will NOT be included in message)
-        if self.current_event == CurrentEvent.HOOK and not include_beep:
+        if self.is_current(CurrentEvent.HOOK) and not include_beep:
+            self.pending_recording = (output_file, started_at)
             self.start_recording(output_file)
 
     def on_hook(self):
@@ -169,23 +414,21 @@ class AudioGuestBook:
         """
         logger.info("Recording time exceeded. Stopping recording.")
         self.audio_interface.stop_recording()
-        self.audio_interface.play_audio(
-            self.config["time_exceeded"], self.config["time_exceeded_volume"], 0
-        )
+        self.play_time_exceeded()
 
     def setup_record_greeting(self):
         """
         Sets up the phone record greeting switch with GPIO based on the configuration.
         """
-        record_greeting_gpio = self.config["record_greeting_gpio"]
+        record_greeting_gpio = self.config.record_greeting_gpio
         if record_greeting_gpio == 0:
             logger.info("record_greeting_gpio is 0, skipping setup.")
             return
-        pull_up = self.config["record_greeting_type"] == "NC"
-        bounce_time = self.config["record_greeting_bounce_time"]
+        pull_up = self.config.record_greeting_type == "NC"
+        bounce_time = self.config.record_greeting_bounce_time
         self.record_greeting = Button(record_greeting_gpio, pull_up=pull_up, bounce_time=bounce_time)
-        self.record_greeting.when_pressed = self.pressed_record_greeting
-        self.record_greeting.when_released = self.released_record_greeting
+        self.record_greeting.when_pressed = self.threadsafe(self.pressed_record_greeting)
+        self.record_greeting.when_released = self.threadsafe(self.released_record_greeting)
 
     def pressed_record_greeting(self):
         """
@@ -199,9 +442,10 @@ class AudioGuestBook:
         logger.info("Record greeting pressed, ready to begin!")
 
         self.current_event = CurrentEvent.RECORD_GREETING # Ensure record greeting can continue
-        # Start the record greeting in a separate thread
-        self.greeting_thread = threading.Thread(target=self.beep_and_record_greeting)
-        self.greeting_thread.start()
+        gc.disable() # No collection pauses during the recording
+        # Start the record greeting as a task on the event loop
+        self.greeting_task = asyncio.create_task(self.beep_and_record_greeting())
+        self.greeting_task.add_done_callback(self.log_failure)
 
     def released_record_greeting(self):
         """
@@ -215,51 +459,102 @@ class AudioGuestBook:
         self.current_event = CurrentEvent.NONE # Stop playback and reset current event
         self.stop_recording_and_playback()
 
-    def beep_and_record_greeting(self):
+    async def beep_and_record_greeting(self):
         """
         Plays the beep and start recording a new greeting message #, checking for the button event.
         """
 
-        self.audio_interface.continue_playback = self.current_event == CurrentEvent.RECORD_GREETING
+        if self.is_current(CurrentEvent.RECORD_GREETING):
+            self.audio_interface.allow_playback()
 
         # Play the beep
-        if self.current_event == CurrentEvent.RECORD_GREETING:
+        if self.is_current(CurrentEvent.RECORD_GREETING):
             logger.info("Playing beep...")
-            self.audio_interface.play_audio(
-                self.config["beep"],
-                self.config["beep_volume"],
-                self.config["beep_start_delay"],
-            )
+            await self.loop.run_in_executor(None, self.play_beep)
 
         # Check if the record greeting message button is still pressed      
-        if self.current_event == CurrentEvent.RECORD_GREETING:
-            path = str(
-                Path(self.config["greeting"])
-            )
+        if self.is_current(CurrentEvent.RECORD_GREETING):
             # Start recording new greeting message       
-            self.start_recording(path)
+            self.start_recording(self.greeting_path)
 
     def stop_recording_and_playback(self):
         """
         Stop recording and playback processes.
+
+        This runs on the event loop so that it is ordered with the next
+        off-hook event. arecord and aplay exit within milliseconds of being
+        terminated, but a process that ignores SIGTERM holds up GPIO event
+        handling for up to 2 seconds per stop before it is killed.
         """
-        self.audio_interface.stop_recording()
-        if hasattr(self, "timer"):
-            self.timer.cancel()
-        if hasattr(self, "greeting_thread") and self.greeting_thread.is_alive():
-            logger.info("Stopping playback.")
+        try:
+            if self.greeting_task is not None and not self.greeting_task.done():
+                self.greeting_task.cancel()
+            self.greeting_task = None
+            self.audio_interface.stop_recording()
+            self.name_recording()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
             self.audio_interface.stop_playback()
+        finally:
+            # Everything allocated during the call is still in the youngest generation
+            gc.collect(0)
+            gc.enable()
+
+    def name_recording(self):
+        """
+        Renames the last guest recording to the ISO timestamp of the call.
+        """
+        if self.pending_recording is None:
+            return
+        output_file, started_at = self.pending_recording
+        self.pending_recording = None
+        final_file = os.path.join(
+            self.recordings_path, f"{datetime.fromtimestamp(started_at / 1e9).isoformat()}.wav"
+        )
+        try:
+            os.rename(output_file, final_file)
+        except FileNotFoundError:
+            # No recording was written, e.g. arecord failed to start
+            pass
+        except OSError as e:
+            logger.error("Error renaming recording %s: %s", output_file, e)
 
     def run(self):
         """
-        Starts the main event loop waiting for phone hook events.
+        Starts the main event loop waiting for phone hook events, until the
+        application is interrupted or terminated (e.g. by systemd).
         """
+        asyncio.set_event_loop(self.loop)
+        # The loop's selector wakes up through its wakeup fd for these signals
+        # only, anything else does not disturb it
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.loop.stop)
         logger.info("System ready. Lift the handset to start.")
-        pause()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Ends any call in progress so the recording is saved, and releases the
+        event loop and its worker threads.
+        """
+        logger.info("Shutting down.")
+        if self.current_event != CurrentEvent.NONE:
+            self.current_event = CurrentEvent.NONE
+            self.stop_recording_and_playback()
+        self.audio_executor.shutdown()
+        self.loop.close()
 
 
 if __name__ == "__main__":
+    # Started before the guest book so that configuration errors are flushed
+    # too, the idle listener thread does not need the pinned affinity
+    log_listener.start()
+    atexit.register(log_listener.stop) # Flush queued records on exit
     CONFIG_PATH = Path(__file__).parent / "../config.yaml"
-    logger.info(f"Using configuration file: {CONFIG_PATH}")
+    logger.info("Using configuration file: %s", CONFIG_PATH)
     guest_book = AudioGuestBook(CONFIG_PATH)
     guest_book.run()
@@ -1,11 +1,20 @@
 import logging
+import os
+import re
+import shutil
 import signal
 import subprocess
-import time
+import threading
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+WAV_HEADER_SIZE = 44
+
+# File systems implementing fallocate natively. On others (e.g. vfat) glibc
+# emulates posix_fallocate by writing every block, which is far too slow.
+FALLOCATE_FILESYSTEMS = {"ext4", "xfs", "btrfs", "f2fs", "tmpfs"}
+
 
 class AudioInterface:
     """
@@ -21,7 +30,14 @@ class AudioInterface:
         file_type (str): File type for recorded audio.
         sample_rate (int): Sampling rate for audio recording.
         channels (int): Number of audio channels for recording.
+        buffer_time (int or None): ALSA ring buffer length in microseconds used by `aplay` and `arecord`.
+        realtime_priority (int): SCHED_FIFO priority of the `aplay` and `arecord` processes, 0 to disable.
+        audio_cpu (int or None): CPU core the `aplay` and `arecord` processes are pinned to, if any.
         recording_process (subprocess.Popen or None): Handle to the current recording process, if any.
+        recording_file (str or None): Path of the current WAV recording, if any.
+        recording_file_size (int or None): Size of the recording file before recording started, None if it did not exist.
+        continue_playback (threading.Event): Set while playback is allowed, cleared by `stop_playback` and replaced by `allow_playback`.
+        sound_cache (dict): In-memory copies (memfd) of played audio files keyed by path, with their modification time.
     """
 
     def __init__(
@@ -33,6 +49,9 @@ class AudioInterface:
         sample_rate=44100,
         channels=1,
         mixer_control_name="Speaker",
+        buffer_time=None,
+        realtime_priority=0,
+        audio_cpu=None,
     ):
         """
         Initializes the audio interface with specified configuration.
@@ -44,6 +63,10 @@ class AudioInterface:
             recording_limit (int): Maximum duration for recording in seconds.
             sample_rate (int, optional): Sampling rate in Hz. Defaults to 44100.
             channels (int, optional): Number of audio channels. Defaults to 1.
+            mixer_control_name (str, optional): Mixer control used to set the volume. Defaults to 'Speaker'.
+            buffer_time (int, optional): ALSA ring buffer length in microseconds. Defaults to None (ALSA default).
+            realtime_priority (int, optional): SCHED_FIFO priority (1-99) for audio processes. Defaults to 0 (disabled).
+            audio_cpu (int, optional): CPU core to pin audio processes to. Defaults to None (no pinning).
         """
         self.alsa_hw_mapping = alsa_hw_mapping
         self.recording_limit = recording_limit
@@ -52,8 +75,29 @@ class AudioInterface:
         self.sample_rate = sample_rate
         self.channels = channels
         self.recording_process = None
+        self.recording_file = None
+        self.recording_file_size = None
+        self.recording_file_lock = threading.Lock()
+        self.fallocate_support = {}
         self.playback_process = None
+        self.continue_playback = threading.Event()
         self.mixer_control_name = mixer_control_name
+        self.buffer_time = buffer_time
+        self.realtime_priority = realtime_priority
+        self.audio_cpu = audio_cpu
+        self.sound_cache = {}
+
+    def alsa_args(self):
+        """
+        Returns the ALSA device and buffer arguments shared by `aplay` and `arecord`.
+
+        A larger ring buffer lets the ALSA device ride out scheduling hiccups on
+        the Pi before an underrun (playback) or overrun (recording) occurs.
+        """
+        args = ["-D", str(self.alsa_hw_mapping)]
+        if self.buffer_time:
+            args.append(f"--buffer-time={int(self.buffer_time)}")
+        return args
 
     def set_volume(self, volume_percentage):
         """
@@ -70,14 +114,69 @@ class AudioInterface:
                 ["amixer", "set", self.mixer_control_name, f"{volume}%"], check=True
             )
         except subprocess.CalledProcessError as e:
-            logger.error(f"Error setting volume: {e}")
+            logger.error("Error setting volume: %s", e)
+
+    def set_audio_scheduling(self, process):
+        """
+        Moves an `aplay` or `arecord` process to the SCHED_FIFO realtime
+        scheduling class so regular processes cannot preempt it mid-period,
+        and pins it to the CPU core reserved for audio.
+
+        Args:
+            process (subprocess.Popen): The audio process.
+        """
+        if self.realtime_priority:
+            try:
+                os.sched_setscheduler(
+                    process.pid, os.SCHED_FIFO, os.sched_param(self.realtime_priority)
+                )
+            except OSError as e:
+                # Needs root or CAP_SYS_NICE, the process may also have exited already
+                logger.warning("Could not set realtime priority: %s", e)
+        if self.audio_cpu is not None:
+            try:
+                os.sched_setaffinity(process.pid, {self.audio_cpu})
+            except OSError as e:
+                logger.warning("Could not set CPU affinity: %s", e)
+
+    def load_sound(self, input_file):
+        """
+        Returns a file descriptor to an in-memory copy of an audio file,
+        rewound to the start. The file is only read from disk if it is not
+        cached yet or has been modified since it was cached.
+
+        Args:
+            input_file (str): Path to the audio file.
+
+        Raises:
+            FileNotFoundError: If the audio file does not exist.
+        """
+        mtime = os.stat(input_file).st_mtime_ns
+        cached = self.sound_cache.get(input_file)
+        if cached is None or cached[0] != mtime:
+            if cached is not None:
+                os.close(cached[1])
+            fd = os.memfd_create(Path(input_file).name)
+            with open(input_file, "rb") as src, open(fd, "wb", closefd=False) as dst:
+                shutil.copyfileobj(src, dst)
+            cached = (mtime, fd)
+            self.sound_cache[input_file] = cached
+        os.lseek(cached[1], 0, os.SEEK_SET)
+        return cached[1]
 
     def play_audio(self, input_file, volume=1, start_delay_sec=0):
         """
         Plays an audio file using `aplay` after setting the volume with `amixer`.
+
+        The file is served from memory (see `load_sound`) as the standard
+        input of `aplay`, so repeated playback does not hit the SD card.
         """
-        if not Path(input_file).exists():
-            logger.error(f"Audio file {input_file} not found.")
+        # Keep the event of this call, allow_playback replaces it for the next
+        continue_playback = self.continue_playback
+        try:
+            audio_fd = self.load_sound(str(input_file))
+        except FileNotFoundError:
+            logger.error("Audio file %s not found.", input_file)
             return
 
         self.set_volume(volume)
@@ -102,35 +201,50 @@ class AudioInterface:
                     check=True,
                 )
                 subprocess.run(
-                    ["aplay", "-D", str(self.alsa_hw_mapping), silence_file], check=True
+                    ["aplay", *self.alsa_args(), silence_file], check=True
                 )
             except subprocess.CalledProcessError as e:
-                logger.error(f"Error generating or playing silence file: {e}")
+                logger.error("Error generating or playing silence file: %s", e)
+
+        if not continue_playback.is_set():
+            return
 
         # Play the actual audio file
         try:
-            self.playback_process = subprocess.Popen(
-                ["aplay", "-D", str(self.alsa_hw_mapping), str(input_file)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+            process = self.playback_process = subprocess.Popen(
+                ["aplay", *self.alsa_args(), "-"],
+                stdin=audio_fd,
+                stdout=subprocess.DEVNULL,
+                stderr=None,
             )
-
-            while self.playback_process and self.playback_process.poll() is None:
-                if not self.continue_playback:
-                    self.playback_process.terminate()
-                    self.playback_process.wait()
-                    break
-                time.sleep(0.1)
+            self.set_audio_scheduling(process)
+            # stop_playback may have run before the process was published
+            if not continue_playback.is_set():
+                process.terminate()
+            # Otherwise stop_playback terminates the process, no need to poll
+            process.wait()
         except subprocess.CalledProcessError as e:
-            logger.error(f"Error playing {input_file}: {e}")
+            logger.error("Error playing %s: %s", input_file, e)
         finally:
             if self.playback_process:
                 self.playback_process = None
 
+    def allow_playback(self):
+        """
+        Allows playback for a new call. A fresh event is installed so that a
+        playback still waiting out the start delay of an earlier call stays
+        stopped.
+        """
+        continue_playback = threading.Event()
+        continue_playback.set()
+        self.continue_playback = continue_playback
+
     def stop_playback(self):
         """
-        Stops the ongoing audio playback process.
+        Stops the ongoing audio playback process and prevents further playback
+        until `allow_playback` is called.
         """
+        self.continue_playback.clear()
         if self.playback_process:
             self.playback_process.terminate()
             try:
@@ -141,6 +255,102 @@ class AudioInterface:
             logger.info("Playback stopped.")
             self.playback_process = None
 
+    def sample_width(self):
+        """
+        Returns an upper bound of the number of bytes per sample of the
+        recording format (e.g. 'cd' or 'S16_LE').
+        """
+        if self.format in ("cd", "cdr", "dat"):
+            return 2
+        bits = re.search(r"\d+", str(self.format))
+        if bits is None:
+            return 4  # FLOAT_LE and friends
+        bits = int(bits.group())
+        return 1 if bits <= 8 else 2 if bits <= 16 else 4 if bits <= 32 else 8
+
+    def supports_fallocate(self, directory):
+        """
+        Returns True if the file system holding a directory allocates space
+        natively, looked up once per directory from /proc/self/mounts.
+
+        Args:
+            directory (str): Directory of the recording.
+        """
+        if directory not in self.fallocate_support:
+            directory_path = os.path.realpath(directory)
+            fs_type, mount_point = None, ""
+            try:
+                with open("/proc/self/mounts") as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) < 3 or len(fields[1]) < len(mount_point):
+                            continue
+                        # The longest mount point containing the directory wins
+                        if directory_path == fields[1] or directory_path.startswith(
+                            fields[1].rstrip("/") + "/"
+                        ):
+                            fs_type, mount_point = fields[2], fields[1]
+            except OSError as e:
+                logger.warning("Could not read mounts: %s", e)
+            self.fallocate_support[directory] = fs_type in FALLOCATE_FILESYSTEMS
+        return self.fallocate_support[directory]
+
+    def preallocate_recording(self, fd, output_file):
+        """
+        Reserves disk space for a full length WAV recording before `arecord`
+        starts writing to it, so the file system does not have to allocate
+        blocks while audio is being captured. The unused space is released
+        again by `trim_recording`.
+
+        Preallocation is skipped on file systems without native fallocate
+        support, where it would write the whole file up front.
+
+        Args:
+            fd (int): Open file descriptor of the output file.
+            output_file (str): Path to the output file where the audio will be saved.
+        """
+        if not self.supports_fallocate(os.path.dirname(os.path.abspath(output_file))):
+            return
+        size = WAV_HEADER_SIZE + (
+            self.sample_rate * self.channels * self.sample_width() * int(self.recording_limit)
+        )
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            logger.warning("Could not preallocate %s: %s", output_file, e)
+
+    def trim_recording(self, output_file, original_size):
+        """
+        Truncates a WAV recording to the length given in its RIFF header,
+        dropping the space left over from `preallocate_recording`.
+
+        If `arecord` never wrote a header (e.g. the capture device was busy),
+        the file is removed, or cut back to its original size if it existed
+        before recording (e.g. the greeting).
+
+        Args:
+            output_file (str): Path to the recorded WAV file.
+            original_size (int or None): Size of the file before recording, None if it did not exist.
+        """
+        try:
+            with open(output_file, "r+b") as f:
+                header = f.read(8)
+                if len(header) == 8 and header[:4] == b"RIFF":
+                    length = int.from_bytes(header[4:8], "little") + 8
+                elif original_size is not None:
+                    length = original_size
+                else:
+                    length = None
+                if length is not None and length < os.fstat(f.fileno()).st_size:
+                    f.truncate(length)
+            if length is None:
+                logger.warning("Discarding %s, nothing was recorded.", output_file)
+                os.unlink(output_file)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Could not trim %s: %s", output_file, e)
+
     def start_recording(self, output_file):
         """
         Starts recording audio to the specified file in a non-blocking manner.
@@ -150,8 +360,7 @@ class AudioInterface:
         """
         command = [
             "arecord",
-            "-D",
-            str(self.alsa_hw_mapping),
+            *self.alsa_args(),
             "-f",
             str(self.format),
             "-t",
@@ -162,14 +371,39 @@ class AudioInterface:
             str(self.sample_rate),
             "-c",
             str(self.channels),
-            output_file,
         ]
-        self.recording_process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_IGN),
-        )
+
+        # arecord removes an existing output file given by name and recreates
+        # it, which would throw away the preallocated space. Open the file here
+        # without truncating it and let arecord write to it as its stdout
+        # instead; it still seeks back to finalize the WAV header.
+        try:
+            original_size = os.stat(output_file).st_size
+        except FileNotFoundError:
+            original_size = None
+        fd = os.open(output_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if self.file_type == "wav":
+                with self.recording_file_lock:
+                    self.recording_file = output_file
+                    self.recording_file_size = original_size
+                self.preallocate_recording(fd, output_file)
+            # Diagnostics go to our stderr (the journal), never to an unread
+            # pipe: once it fills up arecord blocks and drops audio
+            self.recording_process = subprocess.Popen(
+                command,
+                stdout=fd,
+                stderr=None,
+                preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_IGN),
+            )
+        except OSError:
+            # arecord could not be started, release the preallocated file
+            self.recording_process = None
+            self.finish_recording_file()
+            raise
+        finally:
+            os.close(fd)
+        self.set_audio_scheduling(self.recording_process)
 
     def stop_recording(self):
         """
@@ -183,3 +417,16 @@ class AudioInterface:
                 # Force kill if not exited
                 self.recording_process.kill()
             logger.info("Recording stopped.")
+        self.finish_recording_file()
+
+    def finish_recording_file(self):
+        """
+        Trims the current WAV recording file, if any, once `arecord` is done
+        with it. `stop_recording` can run concurrently on the event loop and
+        for the time exceeded event, only one of them gets the file to trim.
+        """
+        with self.recording_file_lock:
+            output_file, original_size = self.recording_file, self.recording_file_size
+            self.recording_file = None
+        if output_file:
+            self.trim_recording(output_file, original_size)